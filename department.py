@@ -18,8 +18,16 @@ Detailed instructions will be provided during execution.
 
 """
 import argparse
+import atexit
+import csv
+import gzip
+import os
+import re
+import sys
+from collections import defaultdict
+from functools import cached_property
 import psycopg2
-import matplotlib.pyplot as plt
+import psycopg2.pool
 
 # GLOBAL VARIABLES FOR POSTGRE SQL DATABASE
 DB_NAME  = 'university-db'    
@@ -29,11 +37,35 @@ HOST     = 'localhost'
 PORT     = '5432'             
 # ===============================================================================================
 
+_POOL = None
+
+def get_connection_pool():
+    """
+    Function to return the connection pool shared by every DatabaseConnection.
+    The pool is created on first use, so importing this module does not connect to the database,
+    and later connections reuse the already established ones instead of reconnecting.
+    """
+    global _POOL
+    if _POOL is None:
+        config = {
+            'dbname': DB_NAME,
+            'user': USER,
+            'password': PASSWORD,
+            'host': HOST,
+            'port': PORT
+        }
+        _POOL = psycopg2.pool.ThreadedConnectionPool(minconn=1, maxconn=4, **config)
+        atexit.register(_POOL.closeall)
+    return _POOL
+
+# one or more department numbers separated by commas, e.g. "1, 3,4"
+DEPT_INPUT_PATTERN = re.compile(r'^\s*\d+(\s*,\s*\d+)*\s*$')
+
 class DatabaseConnection:
     """
     class for a database connection. 
-    with statement, it automatically establishes a connection to the database when the context is entered
-    and closes the connection when the context is exited.
+    with statement, it automatically takes a connection from the shared connection pool when the context is entered
+    and returns the connection to the pool when the context is exited.
     """
     def __init__(self):
         """
@@ -46,29 +78,26 @@ class DatabaseConnection:
         self.cursor = None
 
     def __enter__(self):
-        config = {
-            'dbname': DB_NAME,
-            'user': USER,
-            'password': PASSWORD,
-            'host': HOST,
-            'port': PORT
-        }
-        self.connection = psycopg2.connect(**config)
+        self.connection = get_connection_pool().getconn()
         self.cursor = self.connection.cursor()
         return self.cursor
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        """ Closes the database connection and commits any pending transactions.
+        """ Commits any pending transactions and returns the connection to the pool.
+            If an error occurred, the connection is closed instead so the failed transaction is discarded.
             Args:
                 exc_type: The exception type (if any) that occurred during the execution of the context block.
                 exc_val: The exception value (if any) that occurred during the execution of the context block.
                 exc_tb: The traceback (if any) that occurred during the execution of the context block. 
         """
-        if self.connection:
-            self.connection.commit()
-            self.connection.close()
         if self.cursor:
             self.cursor.close()
+        if self.connection:
+            if exc_type is None:
+                self.connection.commit()
+                get_connection_pool().putconn(self.connection)
+            else:
+                get_connection_pool().putconn(self.connection, close=True)
 
         if exc_type or exc_val or exc_tb:
             print(f'Error: {exc_type}, {exc_val}, {exc_tb}')
@@ -90,22 +119,106 @@ def get_arg_terms():
 
     return args
 
-def write_results_to_csv(header: list, results: list, filename: str):
+def open_csv_file(filename: str):
+    """
+    Function to open a csv file for writing.
+    If the filename ends with '.gz', the file is gzip-compressed (compression level 1, cheap on CPU) as it is written.
+    Args:
+        filename (str): the name of the file to write to
+    """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'wt', compresslevel=1, encoding='utf-8', newline='')
+    return open(filename, 'w', newline='', encoding='utf-8', buffering=1<<20)
+
+def write_results_to_csv(header: list, results, filename: str):
     """
     Function to write results to a csv file.
     Args:
         header (list): a list of strings representing the header of the CSV
-        results (list): a list of tuples, where each tuple is a row in the csv
-        filename (str): the name of the file to write to
+        results (iterable): rows to write, where each row is a tuple; a list, a generator or a cursor
+        filename (str): the name of the file to write to (gzip-compressed if it ends with '.gz')
     """
-    if len(header) != len(results[0]):
+    rows = iter(results)
+    first_row = next(rows, None)
+    if first_row is not None and len(header) != len(first_row):
         raise ValueError('The number of columns in the header must match the number of columns in each row')
 
-    with open(filename, 'w', newline='', encoding='utf-8') as f:
+    with open_csv_file(filename) as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(header)
+        if first_row is not None:
+            writer.writerow(first_row)
+        writer.writerows(rows)
+
+def stream_rows(cursor, query: str, params=None, size: int = 5000):
+    """
+    Function to execute a query and yield its rows, fetching size rows at a time with fetchmany.
+    With a server-side cursor (see get_named_cursor), only one batch of rows is held in Python memory.
+    Args:
+        cursor: a psycopg2 cursor object used to run the query
+        query (str): the SQL statement to execute
+        params (tuple): parameters to bind into the query (optional)
+        size (int): the number of rows fetched per batch
+    """
+    cursor.execute(query, params)
+    while True:
+        batch = cursor.fetchmany(size)
+        if not batch:
+            break
+        yield from batch
+
+def copy_query_to_csv(cursor, query: str, header: list, filename: str):
+    """
+    Function to export the results of a query to a csv file with a COPY statement.
+    PostgreSQL formats the rows as CSV on the server and streams them straight into the file,
+    so the result set is never held in Python memory.
+    Args:
+        cursor: a psycopg2 cursor object used to run the query
+        query (str): a SELECT statement whose results will be exported
+        header (list): a list of strings representing the header of the CSV
+        filename (str): the name of the file to write to (gzip-compressed if it ends with '.gz')
+    """
+    query = query.strip().rstrip(';')
+
+    with open_csv_file(filename) as f:
         f.write(','.join(header) + '\n')
-        for row in results:
-            formatted_row = [str(element) for element in row]
-            f.write(','.join(formatted_row) + '\n')
+        cursor.copy_expert(f'COPY ({query}) TO STDOUT WITH CSV', f)
+
+def get_named_cursor(connection, name: str, itersize: int = 2000):
+    """
+    Function to create a server-side (named) cursor on a connection.
+    Iterating over it fetches rows from PostgreSQL in batches of itersize rows
+    instead of transferring the whole result set at once.
+    Args:
+        connection: a psycopg2 database connection object
+        name (str): the name of the server-side cursor
+        itersize (int): the number of rows fetched per round trip while iterating
+    """
+    cursor = connection.cursor(name=name)
+    cursor.itersize = itersize
+    return cursor
+
+def is_headless():
+    """
+    Function to check whether the program runs without a display to show plots on.
+    This is the case in batch/CI runs (the CI environment variable is set) and, on Linux, 
+    when no X11 or Wayland session is set in the environment.
+    """
+    if os.environ.get('CI'):
+        return True
+    return sys.platform.startswith('linux') and not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+def import_pyplot():
+    """
+    Function to import matplotlib.pyplot when a plot is actually created, 
+    so runs that only export CSV files never load matplotlib.
+    Without a display, the non-interactive 'Agg' backend is selected so no GUI toolkit is loaded just to save PNG files.
+    """
+    import matplotlib
+    if is_headless():
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
 
 def get_valid_input(names):
     """
@@ -115,19 +228,17 @@ def get_valid_input(names):
     Arg: 
         name (list): a list of strings representing all department names
     """
+    valid_numbers = range(1, len(names) + 1)
     while True:
 
         input_dept = input("Enter department number(s) to check (single or multiple input, comma-separated): ")
-        str_dept_inputs = input_dept.split(",")
         
-        if all(dep.isdigit() for dep in str_dept_inputs):
-            int_dept_inputs = [int(dep) - 1 for dep in str_dept_inputs]
-            if all(0 <= dep < len(names) for dep in int_dept_inputs):
-                return int_dept_inputs
-        print("Invalid input")
-        print("Make sure to enter accurate department number (see below)")
-        for i, name in enumerate(names, start=1):
-            print(f"{i}: {name}")
+        if DEPT_INPUT_PATTERN.match(input_dept):
+            dept_numbers = [int(dep) for dep in input_dept.split(",")]
+            if all(dep in valid_numbers for dep in dept_numbers):
+                # drop repeated numbers but keep the order they were entered in
+                return [dep - 1 for dep in dict.fromkeys(dept_numbers)]
+        print(f"Invalid input: enter department numbers between 1 and {len(names)}, separated by commas")
 
 # ==========================================================================================
 class Department:
@@ -135,14 +246,13 @@ class Department:
     
     Attributes:
         db_cursor: Database cursor object.
+        dept_names_and_years: Department names and years, queried together once and cached.
         dept_names: List of department names.
-        total_years_sems: List of total years and semesters.
-        all_years: List of all years.
+        total_years_sems: List of (year, semester) pairs (computed once and cached).
+        all_years: List of all years in the offered range.
         
     Methods:
         create_info_database(): Export metadata on tables and columns to a CSV file.
-        get_all_dept_names(): Retrieve all department names.
-        get_all_years_sem(): Retrieve all years and semesters.
         dep_enrollment(): Export changes in student enrollment to a CSV file.
         spec_dep_enrollment_by_year(): Plot student enrollment changes by department.
         dep_salary_statistics(): Create salary statistics table and plots.
@@ -151,9 +261,6 @@ class Department:
     def __init__(self, db_cursor):
         
         self.db_cursor=db_cursor
-        self.dept_names = []
-        self.total_years_sems = []
-        self.all_years = []
         
     def create_info_database(self): 
         """
@@ -169,54 +276,49 @@ class Department:
                                 WHERE s.table_schema = 'public'
                                 GROUP BY s.table_name, s.column_name, s.data_type Order BY s.table_name; """
 
-        self.db_cursor.execute(table_meta_query)
-        table_meta_info = self.db_cursor.fetchall()
-        list_table_meta_info = []
-        for table_info in table_meta_info:
-                list_table_meta_info.append(table_info)
-                
         header = ["Table Name","Column Name", "Data Type", "Constraints"]
-        write_results_to_csv(header, list_table_meta_info, 'table_info.csv')
+        copy_query_to_csv(self.db_cursor, table_meta_query, header, 'table_info.csv')
         print("Metadata about Tables and Columns in database have been exported to 'table_info.csv'")
     
-    def get_all_dept_names(self):
+    @cached_property
+    def dept_names_and_years(self):
         """
-        Function to retrieve all department names within the university
+        All department names within the university and every year from the first to the last year courses are offered, 
+        retrieved together in a single round trip as two arrays. 
+        The year range is computed in SQL, so only the bounds are looked up in teaches.
+        The query runs on first access only; later accesses reuse the cached lists.
         
         """
-        self.dept_names =[]
-        dept_name_query = """ SELECT dept_name FROM department; """
-        self.db_cursor.execute(dept_name_query)
-        data = self.db_cursor.fetchall()
-        for row in data: 
-            self.dept_names.append(row[0])
-
-
-    def get_all_years_sem(self): 
+        dept_years_query = """ WITH yrs AS (SELECT min(year)::int AS lo, max(year)::int AS hi FROM teaches)
+                                SELECT ARRAY(SELECT dept_name FROM department),
+                                       ARRAY(SELECT y FROM yrs, generate_series(lo, hi) AS y ORDER BY y); """
+        self.db_cursor.execute(dept_years_query)
+        return self.db_cursor.fetchone()
+
+    @property
+    def dept_names(self):
         """
-        Function to retrieve all years and semesters 
-        when all courses are offered within the univesity
+        All department names within the university.
         
         """
+        return self.dept_names_and_years[0]
+
+    @property
+    def all_years(self):
+        """
+        All years from the first to the last year courses are offered within the univesity, in ascending order.
         
-        self.all_years=[]
-        years_query = """ SELECT DISTINCT year FROM teaches; """
-        
-        self.db_cursor.execute(years_query)
-        year_data = self.db_cursor.fetchall()
-        for y in year_data:
-            self.all_years.append(y[0])  
+        """
+        return self.dept_names_and_years[1]
+
+    @cached_property
+    def total_years_sems(self): 
+        """
+        All (year, semester) pairs between the first and the last year courses are offered, 
+        in plot order such as (2001, 'Fall'), (2001, 'Spring'), (2002, 'Fall'), ...
         
-        # Merge year and semester for plot labels for later use
-        self.total_years_sems=[]
-        min_year = min(self.all_years)
-        max_year = max(self.all_years)
-        while min_year <= max_year:
-            year_fall = str(min_year) + ' ' + 'Fall'
-            self.total_years_sems.append(year_fall)
-            year_spring = str(min_year) + ' ' + 'Spring'
-            self.total_years_sems.append(year_spring)
-            min_year += 1
+        """
+        return [(year, semester) for year in self.all_years for semester in ('Fall', 'Spring')]
             
     def dep_enrollment(self): 
         """
@@ -228,32 +330,13 @@ class Department:
           The number of students taking the courses
         """
         #SQL query statement to extract data about department enrollment changes by year and semester 
-        Dep_enrollment_by_year = """ SELECT t.year, t.semester, c.dept_name, COUNT(distinct c.course_id) as total_course_num_dep, COUNT(distinct s.ID) AS total_student_enroll
+        Dep_enrollment_by_year = """ SELECT t.year, t.semester, c.dept_name, COUNT(distinct c.course_id) as total_course_num_dep, COUNT(distinct t.ID) AS total_student_enroll
                                 FROM course AS c 
                                 JOIN takes AS t ON t.course_id = c.course_id
-                                JOIN student AS s ON s.ID = t.ID
-                                GROUP BY t.year, t.semester, c.course_id, c.dept_name 
+                                GROUP BY t.year, t.semester, c.dept_name 
                                 ORDER BY t.year, t.semester, c.dept_name; """
-        list_results = []
-        years = []
-        semesters =[]
-        dept_names =[]
-        total_course_offer_num = []
-        total_student_enroll = []
-        
-        self.db_cursor.execute(Dep_enrollment_by_year)
-        results = self.db_cursor.fetchall()
-            
-        for row in results: 
-            list_results.append(list(row))
-            years.append(row[0])
-            semesters.append(row[1])
-            dept_names.append(row[2])
-            total_course_offer_num.append(row[3])
-            total_student_enroll.append(row[4])
-            
         header = ['Year', 'Semesters', 'Department', 'Num of Offered Courses', 'Num of enrolled students']
-        write_results_to_csv(header, list_results, 'dep_course_stat_by_year.csv')
+        copy_query_to_csv(self.db_cursor, Dep_enrollment_by_year, header, 'dep_course_stat_by_year.csv')
         print("Student Enrollments for courses offered by departments across years and semesters have been exported to 'dep_course_stat_by_year.csv'")
 
     def spec_dep_enrollment_by_year(self): 
@@ -263,11 +346,6 @@ class Department:
         The results will be exported to a PNG file.
 
         """ 
-        #get all deppartment names within the university 
-        self.get_all_dept_names()
-        #get all years and semsters when courses are offered 
-        self.get_all_years_sem()
-
         # prompt to request users to specific department 
         var = input("Do you want to check department enrollment change by years? (y/n): ")
         if var.lower() in ['yes', 'y']:
@@ -279,48 +357,48 @@ class Department:
 
         input_names =[self.dept_names[index] for index in int_dept_inputs] 
         
-        input_dep_enrollment_by_year = """ SELECT c.dept_name, t.year, t.semester, COUNT(distinct s.ID) AS total_student_enroll
-                                FROM course AS c 
-                                JOIN takes AS t ON t.course_id = c.course_id
-                                JOIN student AS s ON s.ID = t.ID 
-                                WHERE c.dept_name IN ({})""".format(','.join(['%s'] * len(input_names)))
-
-        input_dep_enrollment_by_year += """ GROUP BY c.dept_name, t.year, t.semester 
-                    ORDER BY c.dept_name, t.year, t.semester; """
-
-        plot_data = {}
-        for name in input_names: 
-            plot_data[name] = {'year':[], 'enroll':[]}
-
-        self.db_cursor.execute(input_dep_enrollment_by_year, input_names)
-        outputs = self.db_cursor.fetchall()
-
-        for row in outputs:
-            year_sem = str(row[1]) + ' ' + row[2]
-            plot_data[row[0]]['year'].append(year_sem)
-            plot_data[row[0]]['enroll'].append(row[3])
-
-        for name in input_names:   
-            no_miss_dep_stu_enroll=[]
-            for year_sem in self.total_years_sems:
-                if year_sem not in plot_data[name]['year']: 
-                    no_miss_dep_stu_enroll.append(0)
-                else: 
-                    i = plot_data[name]['year'].index(year_sem)
-                    no_miss_dep_stu_enroll.append(plot_data[name]['enroll'][i])
-            plot_data[name]['enroll'] = no_miss_dep_stu_enroll
+        # every selected department is crossed with every year and semester,
+        # so semesters without any enrollment come back as 0 instead of missing rows
+        input_dep_enrollment_by_year = """ WITH selected_dept AS (
+                                    SELECT dept_name FROM department WHERE dept_name = ANY(%s)),
+                                enrollment AS (
+                                    SELECT c.dept_name, t.year, t.semester, COUNT(distinct t.ID) AS total_student_enroll
+                                    FROM course AS c 
+                                    JOIN selected_dept AS d ON d.dept_name = c.dept_name
+                                    JOIN takes AS t ON t.course_id = c.course_id
+                                    GROUP BY c.dept_name, t.year, t.semester)
+                                SELECT d.dept_name, y.year, sem.semester, COALESCE(e.total_student_enroll, 0)
+                                FROM selected_dept AS d
+                                CROSS JOIN generate_series(%s, %s) AS y(year)
+                                CROSS JOIN (VALUES ('Fall'), ('Spring')) AS sem(semester)
+                                LEFT JOIN enrollment AS e 
+                                    ON e.dept_name = d.dept_name AND e.year = y.year AND e.semester = sem.semester
+                                ORDER BY d.dept_name, y.year, sem.semester; """
+
+        # enrollment series per department, in the order of total_years_sems
+        plot_data = defaultdict(list)
+
+        params = (input_names, self.all_years[0], self.all_years[-1])
+        with get_named_cursor(self.db_cursor.connection, 'dep_stream') as stream_cursor:
+            stream_cursor.execute(input_dep_enrollment_by_year, params)
+            for row in stream_cursor:
+                plot_data[row[0]].append(row[3])
         
         #create line plot for student enrollment changes by department
+        plt = import_pyplot()
+        year_sem_labels = [f'{year} {semester}' for year, semester in self.total_years_sems]
         plt.figure(figsize=(10, 5))
         for dep_name in input_names:
-            plt.plot(self.total_years_sems, plot_data[dep_name]['enroll'], marker='o', label=dep_name)
+            plt.plot(year_sem_labels, plot_data[dep_name], marker='o', label=dep_name)
         plt.xlabel('Year Semester')
         plt.xticks(rotation=45)
         plt.ylabel('Student Enrollment')
         plt.title('Department Student Enrollment by Year')
         plt.legend()
         plt.savefig('dept_enrollment.png')
-        plt.show()
+        if not is_headless():
+            plt.show()
+        plt.close()
  
     def dep_salary_statistics(self):
         """
@@ -335,39 +413,23 @@ class Department:
           'Standard Deviation of Salary' 
         """
 
-        Dep_Sal_Stat = """SELECT dept_name, COUNT(distinct ID), PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY salary) AS median_salary,
-                    avg(salary) AS average_salary, STDDEV_POP(salary) AS std_dev_salary
+        Dep_Sal_Stat = """SELECT dept_name, COUNT(*), PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY salary) AS median_salary,
+                    avg(salary)::float8 AS average_salary, STDDEV_POP(salary)::float8 AS std_dev_salary
                 FROM instructor
                 GROUP BY dept_name;"""
 
         self.db_cursor.execute(Dep_Sal_Stat)
         results = self.db_cursor.fetchall()
-        list_results = []
-        dept_names =[]
-        num_instructor = []
-        median_salaries =[]
-        average_salaries =[]
-        std_dev_salaries = []
-
-        for row in results: 
-            list_results.append(list(row))
-            dept_names.append(row[0])
-            num_instructor.append(row[1])
-            median_salaries.append(row[2])
-            average_salaries.append(row[3])
-            if row[4] is not None:
-                std_dev_salaries.append(row[4])
-            else:
-                std_dev_salaries.append(0)
+        dept_names, num_instructor, median_salaries, average_salaries, std_dev_salaries = map(list, zip(*results))
+        std_dev_salaries = [0 if std is None else std for std in std_dev_salaries]
 
+        plt = import_pyplot()
         plt.figure(figsize=(10, 5))
         plt.bar(dept_names, median_salaries, color='yellow', alpha=0.7, label='Median Salary')
         plt.plot(dept_names, average_salaries, color='blue', label='Average Salary')
 
-        for i, dept_name in enumerate(dept_names):
-            plt.vlines(dept_name, average_salaries[i] - std_dev_salaries[i], average_salaries[i] + std_dev_salaries[i],
-                    color='green')
-        plt.plot([], [], color='green', label='Standard Deviation')
+        plt.errorbar(dept_names, average_salaries, yerr=std_dev_salaries, fmt='none', ecolor='green',
+                     label='Standard Deviation')
 
         plt.xlabel('Department')
         plt.xticks(rotation=45)
@@ -375,10 +437,12 @@ class Department:
         plt.title('Median, Average, and Stndard Deviation of Instructor Salaries by Department')
         plt.legend()
         plt.savefig('dep_salary_stats.png')
-        plt.show()
+        if not is_headless():
+            plt.show()
+        plt.close()
 
         header = ['Department', 'Numboer of Instructors', 'Median Salary',  'Average Salaries', 'Std Dev Salary']
-        write_results_to_csv(header, list_results, 'dep_salary_stat.csv')
+        write_results_to_csv(header, results, 'dep_salary_stat.csv')
         print("Instructor salary statistics by departments have been exported to 'dep_salary_stat.csv'")
     
 if __name__ == '__main__':
@@ -102,6 +102,8 @@ create table time_slot
 	 start_min		numeric(2) check (start_min >= 0 and start_min < 60),
 	 end_hr			numeric(2) check (end_hr >= 0 and end_hr < 24),
 	 end_min		numeric(2) check (end_min >= 0 and end_min < 60),
+	 start_minutes		int generated always as (start_hr * 60 + start_min) stored,
+	 end_minutes		int generated always as (end_hr * 60 + end_min) stored,
 	 primary key (time_slot_id, day, start_hr, start_min)
 	);
 